@@ -8,15 +8,26 @@ Usage:
     python batch_process.py --folder ../../datasets --out ../../overlays --product viirs_ndvi --parallel 4
 """
 import argparse
+import contextlib
+import functools
+import heapq
+import io
 import os
 import re
 import sys
 from pathlib import Path
 from datetime import datetime, timedelta
-import subprocess
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import json
 
+try:
+    import orjson  # faster manifest serialization
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
 # Product detection patterns and settings
 PRODUCT_PATTERNS = {
     'viirs_ndvi': {
@@ -72,6 +83,7 @@ PRODUCT_PATTERNS = {
 }
 
 
+@functools.lru_cache(maxsize=None)
 def parse_julian_date(year_day_str):
     """Convert YYYYDDD (year + day-of-year) to YYYY-MM-DD"""
     year = int(year_day_str[:4])
@@ -80,80 +92,149 @@ def parse_julian_date(year_day_str):
     return date.strftime('%Y-%m-%d')
 
 
+# All product patterns as one alternation; each product is a named group
+# wrapping its own pattern, whose date capture is the next group index.
+_PRODUCT_RE = re.compile('|'.join(
+    f"(?P<{key}>{config['pattern']})" for key, config in PRODUCT_PATTERNS.items()
+))
+
+
 def detect_product(filename):
     """Detect product type from filename"""
-    for product_key, config in PRODUCT_PATTERNS.items():
-        match = re.search(config['pattern'], filename)
-        if match:
-            julian_date = match.group(1)
-            date = parse_julian_date(julian_date)
-            return product_key, config, date
-    return None, None, None
+    match = _PRODUCT_RE.search(filename)
+    if not match:
+        return None, None, None
+    product_key = match.lastgroup
+    date = parse_julian_date(match.group(match.lastindex + 1))
+    return product_key, PRODUCT_PATTERNS[product_key], date
 
 
 def scan_folder(folder_path, product_filter=None):
     """Scan folder for HDF/HDF5 files and group by product type"""
-    folder = Path(folder_path)
     files_by_product = {}
     
-    for file_path in folder.glob('*'):
-        if file_path.suffix.lower() not in ['.h5', '.hdf', '.hdf5']:
-            continue
-            
-        product_key, config, date = detect_product(file_path.name)
+    # scandir gives names and entry types from the directory listing itself,
+    # so no per-file stat() is needed
+    with os.scandir(folder_path) as it:
+        paths = sorted(
+            entry.path for entry in it
+            if entry.name.lower().endswith(('.h5', '.hdf', '.hdf5'))
+            and entry.is_file()
+        )
+    
+    # One regex search per name; dates repeat across products, so the
+    # julian-date conversion is cached
+    for path in paths:
+        name = os.path.basename(path)
+        product_key, config, date = detect_product(name)
         if not product_key:
-            print(f"[!] Unknown product: {file_path.name} (skipping)")
+            print(f"[!] Unknown product: {name} (skipping)")
             continue
             
         if product_filter and product_key != product_filter:
             continue
             
-        if product_key not in files_by_product:
-            files_by_product[product_key] = []
-            
-        files_by_product[product_key].append({
-            'path': str(file_path),
+        files_by_product.setdefault(product_key, []).append({
+            'path': path,
             'date': date,
             'config': config
         })
     
-    # Sort by date
+    # Sort by date (names were sorted, so this is a linear pass for
+    # fixed-width PRODUCT.AYYYYDDD names)
     for product_key in files_by_product:
         files_by_product[product_key].sort(key=lambda x: x['date'])
     
     return files_by_product
 
 
-def process_file(file_info, out_dir, script_path):
-    """Process a single file"""
+def find_processed(out_dir):
+    """Return {(overlay_id, date)} for overlays whose meta.json already exists"""
+    processed = set()
+    if not os.path.isdir(out_dir):
+        return processed
+    with os.scandir(out_dir) as products:
+        for product in products:
+            if not product.is_dir():
+                continue
+            with os.scandir(product.path) as dates:
+                for date in dates:
+                    # meta.json is written last, so it marks a complete overlay
+                    if date.is_dir() and os.path.exists(os.path.join(date.path, 'meta.json')):
+                        processed.add((product.name, date.name))
+    return processed
+
+
+def _init_worker():
+    """Import the converter (numpy, h5py, PIL, pyhdf, ...) once per worker process"""
+    import hdf_to_overlay  # noqa: F401
+
+
+def _failure(date, e):
+    return False, date, f"{type(e).__name__}: {e}"
+
+
+def process_file(file_info, out_dir, device='cpu', writer=None, image_format='png', raw_format='f32'):
+    """Process a single file in this process via hdf_to_overlay.
+
+    With a `writer` thread pool the PNG/raw/meta writes are queued there and a
+    Future of the (success, date, error) result is returned, so the caller can
+    start on the next file while this one is encoded.
+    """
+    from hdf_to_overlay import build_parser, render, write_outputs
+
     config = file_info['config']
     file_path = file_info['path']
     date = file_info['date']
     
-    cmd = [
-        sys.executable,
-        script_path,
+    argv = [
         '--in', file_path,
         '--id', config['id'],
         '--date', date,
-        '--out', out_dir
+        '--out', out_dir,
+        '--device', device,
+        '--image-format', image_format,
+        '--raw-format', raw_format
     ]
     
     if config['var']:
-        cmd.extend(['--var', config['var']])
+        argv.extend(['--var', config['var']])
     if config['min'] is not None:
-        cmd.extend(['--min', str(config['min'])])
+        argv.extend(['--min', str(config['min'])])
     if config['max'] is not None:
-        cmd.extend(['--max', str(config['max'])])
+        argv.extend(['--max', str(config['max'])])
     
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        if result.returncode == 0:
+    def write(rendered):
+        try:
+            write_outputs(*rendered)
             return True, date, None
-        else:
-            return False, date, result.stderr
+        except Exception as e:
+            return _failure(date, e)
+    
+    try:
+        # Keep per-file converter chatter out of the batch progress output
+        with contextlib.redirect_stdout(io.StringIO()):
+            rendered = render(build_parser().parse_args(argv))
     except Exception as e:
-        return False, date, str(e)
+        if writer is None:
+            return _failure(date, e)
+        failed = Future()
+        failed.set_result(_failure(date, e))
+        return failed
+    
+    if writer is None:
+        return write(rendered)
+    return writer.submit(write, rendered)
+
+
+def report(i, total, task, success, date, error):
+    """Print one progress line for a finished file"""
+    if success:
+        print(f"[{i}/{total}] [OK] {task['config']['name']} - {date}")
+    else:
+        print(f"[{i}/{total}] [FAIL] {task['config']['name']} - {date}")
+        if error:
+            print(f"    Error: {error[:100]}")
 
 
 def update_manifest(out_dir, files_by_product):
@@ -162,7 +243,7 @@ def update_manifest(out_dir, files_by_product):
     
     # Load existing manifest or create new
     if manifest_path.exists():
-        with open(manifest_path, 'r') as f:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
             manifest = json.load(f)
     else:
         manifest = {'overlays': []}
@@ -175,10 +256,12 @@ def update_manifest(out_dir, files_by_product):
         # Find existing overlay entry or create new
         overlay = next((o for o in manifest['overlays'] if o['id'] == config['id']), None)
         if overlay:
-            # Merge dates (keep unique, sorted)
-            existing_dates = set(overlay.get('dates', []))
-            all_dates = sorted(set(dates) | existing_dates)
-            overlay['dates'] = all_dates
+            # Merge dates (keep unique, sorted). The manifest is written
+            # sorted, so trust its order and only re-sort a hand-edited list
+            existing_dates = overlay.get('dates', [])
+            if any(a > b for a, b in zip(existing_dates, existing_dates[1:])):
+                existing_dates = sorted(existing_dates)
+            overlay['dates'] = list(dict.fromkeys(heapq.merge(existing_dates, dates)))
         else:
             # Create new entry
             manifest['overlays'].append({
@@ -189,9 +272,16 @@ def update_manifest(out_dir, files_by_product):
                 'dates': dates
             })
     
-    # Write updated manifest
-    with open(manifest_path, 'w') as f:
-        json.dump(manifest, f, indent=2)
+    # Write updated manifest atomically so a crash never leaves it truncated.
+    # orjson emits UTF-8 (e.g. 'albedo (0–1)'), so readers open it as UTF-8
+    if HAVE_ORJSON:
+        data = orjson.dumps(manifest, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(manifest, indent=2).encode('utf-8')
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, manifest_path)
     
     print(f"[+] Updated manifest: {manifest_path}")
 
@@ -204,17 +294,27 @@ def main():
                        help='Process only specific product type (default: all)')
     parser.add_argument('--parallel', type=int, default=1, 
                        help='Number of parallel processes (default: 1)')
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                       help='Compute device for the per-file pipeline (cuda needs CuPy)')
+    parser.add_argument('--image-format', choices=['png', 'png8', 'webp'], default='png',
+                       help='Color image encoding (see hdf_to_overlay.py --image-format)')
+    parser.add_argument('--raw-format', choices=['none', 'f32', 'f16', 'zstd-f16'], default='f32',
+                       help='Raw field layout (see hdf_to_overlay.py --raw-format)')
+    parser.add_argument('--force', action='store_true',
+                       help='Reprocess files whose overlay already exists in --out')
     parser.add_argument('--dry-run', action='store_true', 
                        help='Show what would be processed without actually processing')
     args = parser.parse_args()
     
-    # Get script path
+    # Converter is imported from alongside this script
     script_dir = Path(__file__).parent
     hdf_script = script_dir / 'hdf_to_overlay.py'
     
     if not hdf_script.exists():
         print(f"[!] Error: hdf_to_overlay.py not found at {hdf_script}")
         sys.exit(1)
+    if str(script_dir) not in sys.path:
+        sys.path.insert(0, str(script_dir))
     
     # Scan folder
     print(f"\n[*] Scanning folder: {args.folder}")
@@ -232,53 +332,69 @@ def main():
         date_range = f"{files[0]['date']} to {files[-1]['date']}"
         print(f"  - {config['name']}: {len(files)} files ({date_range})")
     
+    all_tasks = []
+    for product_key, files in files_by_product.items():
+        all_tasks.extend(files)
+    
+    # Incremental mode: skip overlays already on disk (manifest still lists them)
+    if not args.force:
+        processed = find_processed(args.out)
+        pending_tasks = [t for t in all_tasks if (t['config']['id'], t['date']) not in processed]
+        skipped = len(all_tasks) - len(pending_tasks)
+        if skipped:
+            print(f"\n[*] Skipping {skipped} already processed file(s) (use --force to redo)")
+        all_tasks = pending_tasks
+    
     if args.dry_run:
         print("\n[*] Dry run - nothing processed")
         sys.exit(0)
     
     # Process files
-    print(f"\n[*] Processing with {args.parallel} worker(s)...\n")
-    
-    all_tasks = []
-    for product_key, files in files_by_product.items():
-        all_tasks.extend(files)
+    print(f"\n[*] Processing {len(all_tasks)} file(s) with {args.parallel} worker(s)...\n")
     
     success_count = 0
     fail_count = 0
     
     if args.parallel > 1:
         # Parallel processing
-        with ProcessPoolExecutor(max_workers=args.parallel) as executor:
+        with ProcessPoolExecutor(max_workers=args.parallel, initializer=_init_worker) as executor:
             futures = {
-                executor.submit(process_file, task, args.out, str(hdf_script)): task 
+                executor.submit(process_file, task, args.out, args.device, None,
+                                args.image_format, args.raw_format): task 
                 for task in all_tasks
             }
             
             for i, future in enumerate(as_completed(futures), 1):
                 task = futures[future]
-                success, date, error = future.result()
-                
+                try:
+                    success, date, error = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died in native code (h5py/pyhdf/OpenCV); the pool
+                    # fails every unfinished task, which are reported as failed
+                    # so the manifest below is still written
+                    success, date, error = _failure(task['date'], e)
+                report(i, len(all_tasks), task, success, date, error)
                 if success:
-                    print(f"[{i}/{len(all_tasks)}] [OK] {task['config']['name']} - {date}")
                     success_count += 1
                 else:
-                    print(f"[{i}/{len(all_tasks)}] [FAIL] {task['config']['name']} - {date}")
-                    if error:
-                        print(f"    Error: {error[:100]}")
                     fail_count += 1
     else:
-        # Sequential processing
-        for i, task in enumerate(all_tasks, 1):
-            success, date, error = process_file(task, args.out, str(hdf_script))
-            
-            if success:
-                print(f"[{i}/{len(all_tasks)}] [OK] {task['config']['name']} - {date}")
-                success_count += 1
-            else:
-                print(f"[{i}/{len(all_tasks)}] [FAIL] {task['config']['name']} - {date}")
-                if error:
-                    print(f"    Error: {error[:100]}")
-                fail_count += 1
+        # Sequential processing; each file's PNG/raw writes overlap with
+        # decoding the next one on a small writer pool
+        with ThreadPoolExecutor(max_workers=2) as writer:
+            pending = deque()
+            for i, task in enumerate(all_tasks, 1):
+                pending.append((i, task, process_file(task, args.out, args.device, writer,
+                                                          args.image_format, args.raw_format)))
+                # At most two files in flight; each holds full-size RGBA + raw arrays
+                while pending and (len(pending) > 2 or i == len(all_tasks)):
+                    n, done_task, future = pending.popleft()
+                    success, date, error = future.result()
+                    report(n, len(all_tasks), done_task, success, date, error)
+                    if success:
+                        success_count += 1
+                    else:
+                        fail_count += 1
     
     # Update manifest
     print("\n[*] Updating manifest...")
@@ -20,10 +20,12 @@ def check_overlays(overlay_dir):
         return {}
     
     products = {}
-    for product_folder in Path(overlay_dir).iterdir():
-        if product_folder.is_dir() and product_folder.name != 'manifest.json':
-            dates = [d.name for d in product_folder.iterdir() if d.is_dir()]
-            products[product_folder.name] = sorted(dates)
+    with os.scandir(overlay_dir) as it:
+        for product_folder in it:
+            if product_folder.is_dir() and product_folder.name != 'manifest.json':
+                with os.scandir(product_folder.path) as dates_it:
+                    dates = [d.name for d in dates_it if d.is_dir()]
+                products[product_folder.name] = sorted(dates)
     
     return products
 
@@ -77,7 +79,7 @@ def main():
     # Check manifest
     print("MANIFEST:")
     if manifest_path.exists():
-        with open(manifest_path, 'r') as f:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
             manifest = json.load(f)
         
         print(f"  [+] manifest.json exists")
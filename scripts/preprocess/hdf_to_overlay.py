@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import argparse, json, os, sys
+import argparse, atexit, json, os, re, sys
+from collections import OrderedDict
 import numpy as np
 from PIL import Image
 import h5py
@@ -10,6 +11,65 @@ try:
 except Exception:
     HAVE_PYHDF = False
 
+try:
+    import cv2  # SIMD/multithreaded resize
+    HAVE_CV2 = True
+except Exception:
+    HAVE_CV2 = False
+
+try:
+    import zstandard as zstd  # --raw-format zstd-f16
+    HAVE_ZSTD = True
+except Exception:
+    HAVE_ZSTD = False
+
+try:
+    import imagecodecs  # faster (libdeflate) PNG encoder
+    HAVE_IMAGECODECS = True
+except Exception:
+    HAVE_IMAGECODECS = False
+
+try:
+    import numba  # fused colormap kernel
+    HAVE_NUMBA = True
+except Exception:
+    HAVE_NUMBA = False
+
+try:
+    from scipy import ndimage
+    HAVE_SCIPY = True
+except Exception:
+    HAVE_SCIPY = False
+
+try:
+    import cupy as cp  # --device cuda
+    import cupyx.scipy.ndimage as cp_ndimage
+    HAVE_CUPY = True
+except Exception:
+    HAVE_CUPY = False
+
+def _xp(a):
+    """Array module (numpy or cupy) that owns `a`."""
+    return cp.get_array_module(a) if HAVE_CUPY else np
+
+def _on_gpu(a):
+    return HAVE_CUPY and isinstance(a, cp.ndarray)
+
+# Per-process scratch arrays reused across files: one buffer per role, replaced
+# (not accumulated) when the shape or dtype changes, and only allocated by the
+# code paths that use them. Only buffers that never leave render() belong here:
+# the color image and arr_rs are handed to write_outputs (possibly on a writer
+# thread) and stay fresh.
+_scratch_bufs = {}
+
+def _scratch(role, shape, dtype, xp=np):
+    key = (role, xp.__name__)
+    buf = _scratch_bufs.get(key)
+    if buf is None or buf.shape != tuple(shape) or buf.dtype != np.dtype(dtype):
+        _scratch_bufs.pop(key, None)
+        buf = _scratch_bufs[key] = xp.empty(shape, dtype=dtype)
+    return buf
+
 def infer_defaults(in_path):
     base = os.path.basename(in_path)
     if base.startswith("VNP13C2"):
@@ -32,36 +92,90 @@ def infer_defaults(in_path):
         ]}
     return {"id":"overlay","name":"Overlay","units":"","candidates":[]}
 
-def read_h5(path, var):
-    with h5py.File(path, "r") as f:
-        if var is None:
-            out = []
-            f.visititems(lambda n, o: out.append(n) if isinstance(o, h5py.Dataset) else None)
-            return None, list(out), {}
-        ds = f[var]
-        data = ds[()]
-        attrs = {k: (ds.attrs[k].item() if hasattr(ds.attrs[k], "shape") and ds.attrs[k].shape==() else ds.attrs[k]) for k in ds.attrs.keys()}
-        return data, None, attrs
-
-def read_hdf4(path, var):
+# Open file handles kept per process so repeat reads of the same granule
+# (e.g. several variables in one batch worker) skip the metadata parse.
+_MAX_OPEN_FILES = 8
+_open_files = OrderedDict()  # abspath -> (handle, close)
+
+def _open_cached(path, opener, closer):
+    key = os.path.abspath(path)
+    entry = _open_files.pop(key, None)
+    if entry is None:
+        entry = (opener(path), closer)
+    _open_files[key] = entry
+    while len(_open_files) > _MAX_OPEN_FILES:
+        _, (old, close) = _open_files.popitem(last=False)
+        close(old)
+    return entry[0]
+
+@atexit.register
+def close_open_files():
+    while _open_files:
+        _, (handle, close) = _open_files.popitem()
+        close(handle)
+
+# Chunk cache large enough to keep a whole decompressed CMG field (3600x7200
+# int16 ~ 50 MB) hot while deflate/shuffle chunks are decoded.
+_H5_CACHE = dict(rdcc_nbytes=64*1024*1024, rdcc_nslots=521, rdcc_w0=0.75)
+
+def _open_h5(path):
+    return _open_cached(path, lambda p: h5py.File(p, "r", **_H5_CACHE), lambda f: f.close())
+
+def _open_hdf4(path):
+    return _open_cached(path, lambda p: SD(p, SDC.READ), lambda h: h.end())
+
+def _pick_var(candidates, available):
+    if not available:
+        raise RuntimeError("No datasets found.")
+    pick = choose_var(candidates, available)
+    print(f"[i] Selected variable: {pick}")
+    return pick
+
+def read_h5(path, var, candidates=()):
+    f = _open_h5(path)
+    if var is None:
+        out = []
+        f.visititems(lambda n, o: out.append(n) if isinstance(o, h5py.Dataset) else None)
+        var = _pick_var(candidates, out)
+    ds = f[var]
+    # Native byte order: read_direct swaps on read, and the Numba kernels
+    # reject big-endian ('>i2') arrays
+    data = np.empty(ds.shape, dtype=ds.dtype.newbyteorder('='))
+    if data.size:
+        ds.read_direct(data)
+    attrs = {k: (ds.attrs[k].item() if hasattr(ds.attrs[k], "shape") and ds.attrs[k].shape==() else ds.attrs[k]) for k in ds.attrs.keys()}
+    return data, attrs
+
+def read_hdf4(path, var, candidates=()):
     if not HAVE_PYHDF:
         raise RuntimeError("pyhdf not installed; cannot read HDF4")
-    hdf = SD(path, SDC.READ)
+    hdf = _open_hdf4(path)
     if var is None:
-        return None, [k for k in hdf.datasets().keys()], {}
+        var = _pick_var(candidates, list(hdf.datasets().keys()))
     sds = hdf.select(var)
     data = sds.get()
     attrs = sds.attributes()
-    return data, None, attrs
+    sds.endaccess()
+    return data, attrs
+
+def load_data(path, var, candidates):
+    """Read `var` from path, autodetecting it from candidates when None, in one open."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".h5", ".hdf5"):
+        return read_h5(path, var or None, candidates)
+    return read_hdf4(path, var or None, candidates)
+
+_VAR_KEYWORDS_RE = re.compile(r"ndvi|evi|snow|albedo|nadir|reflectance", re.IGNORECASE)
 
 def choose_var(candidates, available):
     if not candidates:
         for name in available:
-            if any(x in name.lower() for x in ("ndvi","evi","snow","albedo","nadir","reflectance")):
+            if _VAR_KEYWORDS_RE.search(name):
                 return name
         return available[0]
+    available_set = set(available)
     for c in candidates:
-        if c in available:
+        if c in available_set:
             return c
     for c in candidates:
         short = c.split("/")[-1]
@@ -70,7 +184,17 @@ def choose_var(candidates, available):
                 return a
     return available[0]
 
-def apply_packed_scaling(arr, attrs):
+if HAVE_NUMBA:
+    @numba.njit(parallel=True, cache=True)
+    def _packed_scaling_numba(flat, sf, ao, has_fv, fv, has_vr, vr0, vr1, out):
+        for i in numba.prange(flat.size):
+            x = flat[i]
+            if (has_fv and x == fv) or (has_vr and (x < vr0 or x > vr1)):
+                out[i] = np.nan
+            else:
+                out[i] = x * sf + ao
+
+def apply_packed_scaling(arr, attrs, out=None):
     def to_scalar(val, default):
         """Convert array or scalar to scalar"""
         if val is None:
@@ -84,52 +208,377 @@ def apply_packed_scaling(arr, attrs):
     vr = attrs.get('valid_range', None)
     fv = attrs.get('_FillValue', None)
     
-    a = arr.astype(np.float32)
+    fv_scalar = to_scalar(fv, None) if fv is not None else None
+    has_vr = vr is not None and hasattr(vr, '__len__') and len(vr) == 2
     
-    if fv is not None:
-        fv_scalar = to_scalar(fv, None)
-        if fv_scalar is not None:
-            a = np.where(arr == fv_scalar, np.nan, a)
-    
-    if vr is not None and hasattr(vr, '__len__') and len(vr) == 2:
-        a = np.where((a < vr[0]) | (a > vr[1]), np.nan, a)
+    # Fill and valid_range are tested on the packed values, so both masks and
+    # the scale/offset fuse into one pass over the input
+    if HAVE_NUMBA and not _on_gpu(arr):
+        if out is None:
+            out = np.empty(arr.shape, dtype=np.float32)
+        native = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('='))
+        _packed_scaling_numba(
+            native.reshape(-1), sf, ao,
+            fv_scalar is not None, fv_scalar if fv_scalar is not None else 0.0,
+            has_vr, float(vr[0]) if has_vr else 0.0, float(vr[1]) if has_vr else 0.0,
+            out.reshape(-1))
+        return out
+
+    xp = _xp(arr)
+    if out is None:
+        a = arr.astype(np.float32)
+    else:
+        a = out
+        xp.copyto(a, arr, casting='unsafe')
+    a *= sf
+    a += ao
     
-    a = a * sf + ao
+    invalid = None
+    if fv_scalar is not None:
+        invalid = arr == fv_scalar
+    if has_vr:
+        out_of_range = (arr < vr[0]) | (arr > vr[1])
+        invalid = out_of_range if invalid is None else xp.logical_or(invalid, out_of_range, out=invalid)
+    if invalid is not None:
+        a[invalid] = np.nan
     return a
 
-def resample_bilinear(data, W, H):
-    valid = np.isfinite(data).astype(np.float32)
-    data_fill = np.where(np.isfinite(data), data, 0.0).astype(np.float32)
-    img = Image.fromarray(data_fill, mode='F').resize((W, H), resample=Image.BILINEAR)
-    msk = Image.fromarray(valid, mode='F').resize((W, H), resample=Image.BILINEAR)
-    out = np.array(img, dtype=np.float32)
-    m = np.array(msk, dtype=np.float32)
-    out[m < 0.5] = np.nan
+def _mask_nearest(invalid, W, H):
+    """Nearest-neighbour (pixel-centre) lookup of a source mask onto a WxH grid.
+
+    A plain row/column gather: no interpolation pass over the output.
+    """
+    xp = _xp(invalid)
+    h, w = invalid.shape
+    rows = ((xp.arange(H) + 0.5) * (h / H)).astype(np.intp)
+    cols = ((xp.arange(W) + 0.5) * (w / W)).astype(np.intp)
+    return invalid[rows][:, cols]
+
+def _resample_bilinear_cuda(data, W, H):
+    invalid = ~cp.isfinite(data)
+    data_fill = cp.nan_to_num(data.astype(cp.float32, copy=False), nan=0.0)
+    # Box prefilter over each shrunk axis so zoom's bilinear taps see the area
+    # average, as INTER_AREA does on the CPU path
+    size = tuple(max(1, int(round(n / m))) for n, m in zip(data.shape, (H, W)))
+    if size != (1, 1):
+        data_fill = cp_ndimage.uniform_filter(data_fill, size=size, mode='nearest')
+    zoom = (H / data.shape[0], W / data.shape[1])
+    out = cp_ndimage.zoom(data_fill, zoom, order=1, grid_mode=True, mode='nearest').astype(cp.float32, copy=False)
+    out[_mask_nearest(invalid, W, H)] = cp.nan
     return out
 
-def colorize_viridis(x01, alphaMask):
-    stops = np.array([
-      [68,1,84],[72,40,120],[62,74,137],[49,104,142],
-      [38,130,142],[31,158,137],[53,183,121],[110,206,88],
-      [181,222,43],[253,231,37]
-    ], dtype=np.float32) / 255.0
-    
+def resample_bilinear(data, W, H, overwrite_input=False):
+    """Resample to WxH (area-averaged when shrinking), NaN where the nearest source pixel is invalid.
+
+    NaNs are zero-filled before interpolation; with overwrite_input=True that
+    happens in place in `data` (only pass scratch arrays), otherwise on a copy.
+    """
+    if _on_gpu(data):
+        return _resample_bilinear_cuda(data, W, H)
+    invalid = np.isfinite(data, out=_scratch("invalid", data.shape, np.bool_))
+    np.logical_not(invalid, out=invalid)
+    any_invalid = invalid.any()
+    data_fill = np.nan_to_num(data.astype(np.float32, copy=not overwrite_input), copy=False, nan=0.0)
+    if HAVE_CV2:
+        # INTER_LINEAR only samples a 2x2 neighbourhood and aliases when
+        # shrinking (the default CMG 3600x7200 -> 2048x4096 case); INTER_AREA
+        # averages like PIL's BILINEAR does on downscale
+        h, w = data.shape
+        if W <= w and H <= h:
+            out = cv2.resize(data_fill, (W, H), interpolation=cv2.INTER_AREA)
+        elif W >= w and H >= h:
+            out = cv2.resize(data_fill, (W, H), interpolation=cv2.INTER_LINEAR)
+        else:
+            # One axis shrinks, the other grows: area-average the shrinking
+            # axis alone, then interpolate the growing one
+            shrunk = cv2.resize(data_fill, (min(W, w), min(H, h)), interpolation=cv2.INTER_AREA)
+            out = cv2.resize(shrunk, (W, H), interpolation=cv2.INTER_LINEAR)
+    elif HAVE_SCIPY:
+        zoom = (H / data.shape[0], W / data.shape[1])
+        out = ndimage.zoom(data_fill, zoom, order=1, grid_mode=True, mode='nearest').astype(np.float32, copy=False)
+    else:
+        img = Image.fromarray(data_fill, mode='F').resize((W, H), resample=Image.BILINEAR)
+        out = np.array(img, dtype=np.float32)
+    # Invalid pixels were zero-filled for the interpolation; mark their
+    # nearest output pixels NaN again straight from the source mask
+    if any_invalid:
+        out[_mask_nearest(invalid, W, H)] = np.nan
+    return out
+
+if HAVE_NUMBA:
+    @numba.njit(cache=True)
+    def _finite_histogram_numba(flat, bins):
+        lo, hi, n = np.inf, -np.inf, 0
+        for v in flat:
+            if np.isfinite(v):
+                n += 1
+                lo = min(lo, v)
+                hi = max(hi, v)
+        hist = np.zeros(bins, dtype=np.int64)
+        if n == 0 or lo == hi:
+            return hist, lo, hi, n
+        scale = bins / (hi - lo)
+        for v in flat:
+            if np.isfinite(v):
+                hist[min(int((v - lo) * scale), bins - 1)] += 1
+        return hist, lo, hi, n
+
+# Elements per np.histogram call in the NumPy fallback, bounding its
+# internal range-mask copies to a few MB
+_HIST_BLOCK = 1 << 20
+
+def _finite_histogram(arr, bins):
+    """(hist, lo, hi, n) over the finite values of arr without copying them out."""
+    if _on_gpu(arr):
+        finite = arr[cp.isfinite(arr)]
+        if finite.size == 0:
+            return None, 0.0, 0.0, 0
+        lo, hi = float(finite.min()), float(finite.max())
+        if lo == hi:
+            return None, lo, hi, int(finite.size)
+        hist, _ = cp.histogram(finite, bins=bins, range=(lo, hi))
+        return cp.asnumpy(hist), lo, hi, int(finite.size)
+    flat = arr.reshape(-1)
+    if HAVE_NUMBA:
+        hist, lo, hi, n = _finite_histogram_numba(flat, bins)
+        return hist, float(lo), float(hi), int(n)
+    # fmin/fmax skip NaN without the all-NaN warning of nanmin/nanmax
+    lo, hi = float(np.fmin.reduce(flat)), float(np.fmax.reduce(flat))
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        # all-NaN, or +-inf present: fall back to the explicit finite copy
+        finite = flat[np.isfinite(flat)]
+        if finite.size == 0:
+            return None, 0.0, 0.0, 0
+        flat, lo, hi = finite, float(finite.min()), float(finite.max())
+    if lo == hi:
+        return None, lo, hi, int(np.count_nonzero(flat == lo))
+    hist = np.zeros(bins, dtype=np.int64)
+    for start in range(0, flat.size, _HIST_BLOCK):
+        hist += np.histogram(flat[start:start + _HIST_BLOCK], bins=bins, range=(lo, hi))[0]
+    return hist, lo, hi, int(hist.sum())
+
+def _values_between(arr, a, b):
+    """(count of finite values below a, finite values in [a, b]) of arr, in blocks."""
+    xp = _xp(arr)
+    flat = arr.reshape(-1)
+    below, parts = 0, []
+    for start in range(0, flat.size, _HIST_BLOCK):
+        blk = flat[start:start + _HIST_BLOCK]
+        below += int(xp.count_nonzero((blk < a) & (blk > -xp.inf)))
+        parts.append(blk[(blk >= a) & (blk <= b)])
+    vals = xp.concatenate(parts)
+    return below, cp.asnumpy(vals) if _on_gpu(vals) else vals
+
+def histogram_percentiles(arr, qs, bins=4096):
+    """nanpercentile for several qs without sorting or copying all finite values.
+
+    The histogram only locates the bins holding the two order statistics each
+    q interpolates between; a second pass pulls just those bins' values and
+    selects exactly, so the result matches np.nanpercentile even when an
+    outlier stretches the bin range.
+    """
+    hist, lo, hi, n = _finite_histogram(arr, bins)
+    if n == 0:
+        return [float("nan")] * len(qs)
+    if lo == hi:
+        return [lo] * len(qs)
+    edges = np.linspace(lo, hi, bins + 1)
+    cdf = np.cumsum(hist)
+    out = []
+    for q in qs:
+        # Same linear interpolation between order statistics as nanpercentile
+        pos = q / 100.0 * (n - 1)
+        i = int(pos)
+        j = min(i + 1, n - 1)
+        k0 = min(int(np.searchsorted(cdf, i, side="right")), bins - 1)
+        k1 = min(int(np.searchsorted(cdf, j, side="right")), bins - 1)
+        below, vals = _values_between(arr, edges[k0], edges[k1 + 1])
+        if vals.size == 0:
+            out.append(float(edges[k0]))
+            continue
+        # Clamp: edge rounding may shift a value across the bin boundary
+        li = min(max(i - below, 0), vals.size - 1)
+        lj = min(max(j - below, 0), vals.size - 1)
+        vals = np.partition(vals, (li, lj))
+        vi, vj = float(vals[li]), float(vals[lj])
+        out.append(vi + (pos - i) * (vj - vi))
+    return out
+
+# 10-stop viridis palette as uint8, plus the per-stop step to the next stop
+# (last row is zero so the top of the range needs no separate upper index).
+_VIRIDIS_U8 = np.array([
+  [68,1,84],[72,40,120],[62,74,137],[49,104,142],
+  [38,130,142],[31,158,137],[53,183,121],[110,206,88],
+  [181,222,43],[253,231,37]
+], dtype=np.uint8)
+_VIRIDIS_BASE = _VIRIDIS_U8.astype(np.float32)
+_VIRIDIS_STEP = np.diff(_VIRIDIS_U8.astype(np.float32), axis=0, append=_VIRIDIS_U8[-1:].astype(np.float32))
+
+if HAVE_NUMBA:
+    # No fastmath: the NaN test below must survive optimization
+    @numba.njit(parallel=True, cache=True)
+    def _viridis_rgba_numba(x01, alpha, base, step, out):
+        H, W = x01.shape
+        n = base.shape[0] - 1
+        for i in numba.prange(H):
+            for j in range(W):
+                v = x01[i, j]
+                v = 0.0 if v != v else v * n
+                i0 = min(max(int(v), 0), n)
+                t = v - i0
+                for c in range(3):
+                    out[i, j, c] = np.uint8(base[i0, c] + t * step[i0, c])
+                out[i, j, 3] = np.uint8(alpha[i, j] * 255)
+
+_VIRIDIS_CUDA_SRC = """
+    float v = isnan(x) ? 0.0f : x * {n}.0f;
+    int i0 = min(max((int)v, 0), {n});
+    float t = v - i0;
+    for (int c = 0; c < 3; ++c)
+        out[4*i + c] = (unsigned char)(base[3*i0 + c] + t * step[3*i0 + c]);
+    out[4*i + 3] = alpha * 255;
+""".format(n=len(_VIRIDIS_U8) - 1)
+_viridis_cuda = None
+
+def _colorize_viridis_cuda(x01, alphaMask, out=None):
+    global _viridis_cuda
+    if _viridis_cuda is None:
+        _viridis_cuda = (
+            cp.ElementwiseKernel(
+                "float32 x, uint8 alpha, raw float32 base, raw float32 step",
+                "raw uint8 out", _VIRIDIS_CUDA_SRC, "viridis_rgba"),
+            cp.asarray(_VIRIDIS_U8, dtype=cp.float32),
+            cp.asarray(_VIRIDIS_STEP),
+        )
+    kernel, base, step = _viridis_cuda
+    if out is None:
+        out = cp.empty(x01.shape + (4,), dtype=cp.uint8)
+    kernel(x01.astype(cp.float32, copy=False), alphaMask.astype(cp.uint8, copy=False), base, step, out)
+    return out
+
+def colorize_viridis(x01, alphaMask, out=None):
+    """Map x01 (already clipped to [0,1], NaN allowed) to RGBA uint8.
+
+    Single gather + fused blend written straight into `out` (H,W,4) uint8,
+    allocated if not given.
+    """
+    if _on_gpu(x01):
+        return _colorize_viridis_cuda(x01, alphaMask, out)
+    if HAVE_NUMBA and x01.ndim == 2:
+        if out is None:
+            out = np.empty(x01.shape + (4,), dtype=np.uint8)
+        _viridis_rgba_numba(x01, alphaMask, _VIRIDIS_BASE, _VIRIDIS_STEP, out)
+        return out
+    n = len(_VIRIDIS_U8) - 1
+    shape = x01.shape
+    idx = np.multiply(x01, n, dtype=np.float32, out=_scratch("idx", shape, np.float32))
     # Replace NaN with 0 for indexing (will be masked by alpha)
-    x01_safe = np.nan_to_num(x01, nan=0.0)
-    idx = x01_safe * (len(stops)-1)
-    i0 = np.clip(np.floor(idx).astype(int), 0, len(stops)-1)
-    i1 = np.clip(i0+1, 0, len(stops)-1)
-    t = np.clip(idx - i0, 0, 1)
-    
-    rgb = (stops[i0]*(1-t[...,None]) + stops[i1]*t[...,None]).clip(0,1)
-    a = (alphaMask*255).astype(np.uint8)
-    rgba = np.dstack([(rgb[...,0]*255).astype(np.uint8),
-                      (rgb[...,1]*255).astype(np.uint8),
-                      (rgb[...,2]*255).astype(np.uint8),
-                      a])
-    return rgba
+    np.nan_to_num(idx, copy=False, nan=0.0)
+    i0 = _scratch("i0", shape, np.int32)
+    np.copyto(i0, idx, casting='unsafe')
+    t = np.subtract(idx, i0, out=idx)
 
-def main():
+    rgb = np.take(_VIRIDIS_STEP, i0, axis=0, out=_scratch("rgb", shape + (3,), np.float32))
+    np.multiply(rgb, t[..., None], out=rgb)
+    np.add(rgb, np.take(_VIRIDIS_U8, i0, axis=0, out=_scratch("base", shape + (3,), np.uint8)), out=rgb)
+
+    if out is None:
+        out = np.empty(x01.shape + (4,), dtype=np.uint8)
+    out[..., :3] = rgb
+    np.multiply(alphaMask, 255, out=out[..., 3], casting='unsafe')
+    return out
+
+# 256-entry palette for --image-format png8: index 0 is the transparent
+# nodata entry, indices 1..255 sample viridis evenly over [0,1].
+# Built with plain NumPy (same base + t*step blend as colorize_viridis) so
+# importing the module never compiles or loads the Numba kernel.
+def _viridis_palette():
+    v = np.linspace(0, 1, 255, dtype=np.float32) * (len(_VIRIDIS_U8) - 1)
+    i0 = v.astype(np.int32)
+    t = (v - i0)[:, None]
+    rgb = (_VIRIDIS_BASE[i0] + t * _VIRIDIS_STEP[i0]).astype(np.uint8)
+    return np.vstack([np.zeros((1, 3), dtype=np.uint8), rgb])
+
+_VIRIDIS_PALETTE = _viridis_palette()
+
+def palette_indices(x01, alphaMask):
+    """Quantize x01 to _VIRIDIS_PALETTE indices (H,W) uint8, 0 where alphaMask is 0."""
+    xp = _xp(x01)
+    idx = xp.multiply(x01, 254, dtype=np.float32)
+    idx += 1.5
+    xp.nan_to_num(idx, copy=False, nan=0.0)
+    out = idx.astype(np.uint8)
+    out[alphaMask == 0] = 0
+    return out
+
+IMAGE_FILES = {
+    "png": "overlay_color.png",
+    "png8": "overlay_color.png",
+    "webp": "overlay_color.webp",
+}
+
+RAW_FILES = {
+    "f32": "overlay_raw.bin",
+    "f16": "overlay_raw.f16.bin",
+    "zstd-f16": "overlay_raw.f16.zst",
+}
+
+def write_raw(arr, out_dir, fmt):
+    """Write the resampled field in the requested on-disk layout; returns file name or None."""
+    if fmt == "none":
+        return None
+    fname = RAW_FILES[fmt]
+    path = os.path.join(out_dir, fname)
+    if fmt == "f32":
+        with open(path, "wb") as f:
+            arr.astype(np.float32, copy=False).tofile(f)
+    elif fmt == "f16":
+        with open(path, "wb") as f:
+            arr.astype(np.float16).tofile(f)
+    else:
+        if not HAVE_ZSTD:
+            raise RuntimeError("zstandard not installed; cannot write --raw-format zstd-f16")
+        with open(path, "wb") as f:
+            f.write(zstd.ZstdCompressor(level=3).compress(arr.astype(np.float16).tobytes()))
+    return fname
+
+def write_image(image, out_dir, fmt):
+    """Encode RGBA (png, webp) or palette indices (png8); returns file name."""
+    fname = IMAGE_FILES[fmt]
+    path = os.path.join(out_dir, fname)
+    if fmt == "png8":
+        img = Image.fromarray(image, mode='P')
+        img.putpalette(_VIRIDIS_PALETTE.tobytes())
+        img.save(path, transparency=0)
+    elif fmt == "webp":
+        Image.fromarray(image, mode='RGBA').save(path, format='WEBP', lossless=True, quality=90, method=0)
+    elif HAVE_IMAGECODECS:
+        with open(path, "wb") as f:
+            f.write(imagecodecs.png_encode(image, level=3))
+    else:
+        Image.fromarray(image, mode='RGBA').save(path)
+    return fname
+
+def write_outputs(out_dir, image, arr_rs, meta):
+    """Write the color image, raw field and meta.json (last, so it marks a complete overlay).
+
+    Only encoding and file I/O (both release the GIL), so batches can run it on
+    a writer thread while the next file is decoded.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    written = {write_image(image, out_dir, meta["image_format"]),
+               write_raw(arr_rs, out_dir, meta["raw_format"])}
+    # Drop files left by an earlier run in another --image-format/--raw-format
+    for fname in {*IMAGE_FILES.values(), *RAW_FILES.values()} - written:
+        try:
+            os.remove(os.path.join(out_dir, fname))
+        except FileNotFoundError:
+            pass
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+      json.dump(meta, f, indent=2)
+    return out_dir
+
+def build_parser():
     ap = argparse.ArgumentParser()
     ap.add_argument("--in", dest="in_path", required=True)
     ap.add_argument("--var", dest="var_path", default=None)
@@ -140,57 +589,52 @@ def main():
     ap.add_argument("--height", type=int, default=2048)
     ap.add_argument("--min", dest="vmin", type=float, default=None)
     ap.add_argument("--max", dest="vmax", type=float, default=None)
-    args = ap.parse_args()
+    ap.add_argument("--raw-format", dest="raw_format", choices=["none", *RAW_FILES], default="f32",
+                    help="on-disk layout of the raw field (default: f32 overlay_raw.bin)")
+    ap.add_argument("--image-format", dest="image_format", choices=list(IMAGE_FILES), default="png",
+                    help="png (RGBA), png8 (palette + tRNS, same file name) or lossless webp")
+    ap.add_argument("--device", choices=["cpu", "cuda"], default="cpu",
+                    help="run scaling/resample/colormap on the GPU via CuPy (default: cpu)")
+    return ap
 
+def render(args):
+    """Decode, scale, resample and colorize one file; returns (out_dir, image, arr_rs, meta) for write_outputs."""
     defaults = infer_defaults(args.in_path)
     overlay_id = args.overlay_id or defaults["id"]
     name = defaults["name"]
     units = defaults["units"]
 
-    ext = os.path.splitext(args.in_path)[1].lower()
-    is_h5 = ext in (".h5", ".hdf5")
-    if is_h5:
-        data, avail, attrs = read_h5(args.in_path, args.var_path)
-    else:
-        data, avail, attrs = read_hdf4(args.in_path, args.var_path if args.var_path else None)
-
-    if data is None:
-        if not avail:
-            print("No datasets found.")
-            sys.exit(2)
-        pick = choose_var(defaults["candidates"], avail)
-        print(f"[i] Selected variable: {pick}")
-        if is_h5:
-            data, _, attrs = read_h5(args.in_path, pick)
-        else:
-            data, _, attrs = read_hdf4(args.in_path, pick)
+    data, attrs = load_data(args.in_path, args.var_path, defaults["candidates"])
+    if args.device == "cuda":
+        if not HAVE_CUPY:
+            raise RuntimeError("cupy not installed; cannot use --device cuda")
+        data = cp.asarray(data)
 
-    arr = apply_packed_scaling(data, attrs)
+    arr = apply_packed_scaling(data, attrs, out=_scratch("scaled", data.shape, np.float32, _xp(data)))
 
     outW, outH = args.width, args.height
-    arr_rs = resample_bilinear(arr, outW, outH)
+    arr_rs = resample_bilinear(arr, outW, outH, overwrite_input=True)
 
-    if args.vmin is None:
-        vmin = float(np.nanpercentile(arr_rs, 2))
-    else:
-        vmin = args.vmin
-    if args.vmax is None:
-        vmax = float(np.nanpercentile(arr_rs, 98))
-    else:
-        vmax = args.vmax
+    vmin, vmax = args.vmin, args.vmax
+    if vmin is None or vmax is None:
+        p2, p98 = histogram_percentiles(arr_rs, (2, 98))
+        vmin = p2 if vmin is None else vmin
+        vmax = p98 if vmax is None else vmax
 
-    x = (arr_rs - vmin) / max(1e-12, (vmax - vmin))
-    x = np.clip(x, 0.0, 1.0)
-    alpha = np.isfinite(arr_rs).astype(np.uint8)
-    rgba = colorize_viridis(x, alpha)
+    xp = _xp(arr_rs)
+    x = xp.subtract(arr_rs, vmin, out=_scratch("x01", arr_rs.shape, np.float32, xp))
+    x /= max(1e-12, (vmax - vmin))
+    xp.clip(x, 0.0, 1.0, out=x)
+    alpha = xp.isfinite(arr_rs, out=_scratch("alpha", arr_rs.shape, np.uint8, xp))
+    if args.image_format == "png8":
+        image = palette_indices(x, alpha)
+    else:
+        image = colorize_viridis(x, alpha)
+    if _on_gpu(arr_rs):
+        # Image/raw encoding stays on the CPU
+        arr_rs, image = cp.asnumpy(arr_rs), cp.asnumpy(image)
 
     out_dir = os.path.join(args.out_root, overlay_id, args.date)
-    os.makedirs(out_dir, exist_ok=True)
-
-    Image.fromarray(rgba, mode='RGBA').save(os.path.join(out_dir, "overlay_color.png"))
-    with open(os.path.join(out_dir, "overlay_raw.bin"), "wb") as f:
-      arr_rs.astype(np.float32).tofile(f)
-
     meta = {
       "id": overlay_id,
       "name": name,
@@ -202,13 +646,29 @@ def main():
       "max": vmax,
       "colormap": "viridis",
       "nodata": "NaN",
+      "image": IMAGE_FILES[args.image_format],
+      "image_format": args.image_format,
+      "raw": RAW_FILES.get(args.raw_format),
+      "raw_format": args.raw_format,
       "notes": "Resampled bilinear from CMG grid; CF packed scaling applied if attrs present."
     }
-    with open(os.path.join(out_dir, "meta.json"), "w") as f:
-      json.dump(meta, f, indent=2)
+    return out_dir, image, arr_rs, meta
 
+def process_one(args):
+    """Convert one HDF file using parsed CLI options; importable for in-process batches."""
+    out_dir, image, arr_rs, meta = render(args)
+    write_outputs(out_dir, image, arr_rs, meta)
     print(f"[OK] Wrote {out_dir}")
-    print(f"  min={vmin:.6g}, max={vmax:.6g}, nan%={np.isnan(arr_rs).mean()*100:.2f}%")
+    print(f"  min={meta['min']:.6g}, max={meta['max']:.6g}, nan%={np.isnan(arr_rs).mean()*100:.2f}%")
+    return out_dir
+
+def main():
+    args = build_parser().parse_args()
+    try:
+        process_one(args)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(2)
 
 if __name__ == "__main__":
     main()